@@ -48,13 +48,43 @@ __author_email__ = 'chris@infoblox.com'
 __license__ = 'BSD'
 
 import logging
-from multiprocessing.dummy import active_children
-from rich import print
+import json
+from rich import print as rprint
 import requests
 import argparse
 import configparser
+import functools
+import os
 import time
-import concurrent.futures
+
+# Use the SIMD accelerated JSON parser if available, else orjson
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if simdjson:
+    _parser = simdjson.Parser()
+
+# Use incremental JSON parsing for filtered lease retrieval if available
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# HTTP status codes for a successful WAPI call
+STATUS_CODES_OK = frozenset(( 200, 201 ))
+
+# Keep-alive sessions keyed on the config they were built from
+_wapi_sessions = {}
+
+# Set once urllib3 certificate warnings have been disabled
+_warnings_disabled = False
 
 
 def parseargs():
@@ -93,6 +123,28 @@ def read_ini(ini_filename):
     Returns:
         config :(dict): Dictionary of BloxOne configuration elements
 
+    '''
+    # Only re-parse the file if it has changed since it was last read
+    try:
+        mtime = os.path.getmtime(ini_filename)
+    except OSError:
+        mtime = None
+
+    return dict(_parse_ini(ini_filename, mtime))
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_ini(ini_filename, mtime):
+    '''
+    Parse ini file, cached on filename and modification time
+
+    Parameters:
+        ini_filename (str): name of inifile
+        mtime (float): modification time of inifile
+
+    Returns:
+        config :(dict): Dictionary of BloxOne configuration elements
+
     '''
     # Local Variables
     cfg = configparser.ConfigParser()
@@ -110,7 +162,7 @@ def read_ini(ini_filename):
         for key in ini_keys:
             # Check for key in BloxOne section
             if key in cfg['NIOS']:
-                config[key] = cfg['NIOS'][key].strip("'\"")
+                config[key] = _unquote(cfg['NIOS'][key])
                 logging.debug('Key {} found in {}: {}'.format(key, ini_filename, config[key]))
             else:
                 logging.warning('Key {} not found in NIOS section.'.format(key))
@@ -122,6 +174,22 @@ def read_ini(ini_filename):
     return config
 
 
+def _unquote(value):
+    '''
+    Remove matching quotes surrounding a value
+
+    Parameters:
+        value (str): value from inifile
+
+    Returns:
+        value without surrounding quotes
+    '''
+    if len(value) > 1 and value[0] in "'\"" and value[-1] == value[0]:
+        value = value[1:-1]
+
+    return value
+
+
 def setup_logging(debug):
     '''
      Set up logging
@@ -154,16 +222,21 @@ def create_session(config):
     Return:
         wapi_session (obj): request session object
     '''
-    headers = { 'content-type': "application/json" }
+    global _warnings_disabled
+
+    # Ask the GM to compress responses (gzip/deflate, br if brotli available)
+    headers = { 'content-type': "application/json",
+                'Accept-Encoding': requests.utils.DEFAULT_ACCEPT_ENCODING }
 
     if config['valid_cert'] == 'true':
         valid_cert = True
     else:
         valid_cert = False
 
-    # Avoid error due to a self-signed cert.
-    if not valid_cert:
+    # Avoid error due to a self-signed cert, only needed once per process
+    if not valid_cert and not _warnings_disabled:
         requests.packages.urllib3.disable_warnings()
+        _warnings_disabled = True
     
     wapi_session = requests.session()
     wapi_session.auth = (config['user'], config['pass'])
@@ -173,6 +246,24 @@ def create_session(config):
     return wapi_session
 
 
+def get_session(config):
+    '''
+    Get the WAPI session for a GM config, creating it on first use
+
+    Parameters:
+        config (dict): GM config
+    
+    Return:
+        wapi_session (obj): request session object
+    '''
+    key = tuple(sorted(config.items()))
+
+    if key not in _wapi_sessions:
+        _wapi_sessions[key] = create_session(config)
+
+    return _wapi_sessions[key]
+
+
 def wapi_call(session, **params):
     '''
     Make wapi call
@@ -184,11 +275,14 @@ def wapi_call(session, **params):
 i   Returns:
         data: JSON response as object (list/dict) or None
     '''
-    status_codes_ok = [ 200, 201 ]
-
     response = session.get(**params)
-    if response.status_code in [ 200, 201 ]:
-        data = response.json()
+    if response.status_code in STATUS_CODES_OK:
+        if simdjson:
+            data = _parser.parse(response.content, recursive=True)
+        elif orjson:
+            data = orjson.loads(response.content)
+        else:
+            data = response.json()
     else:
         logging.debug(f'HTTP response: {response.status_code}')
         logging.debug(f'Body: {response.content}')
@@ -197,26 +291,128 @@ i   Returns:
     return data
 
 
-def get_network_leases(config, ipaddr, net_view="default"):
+def page_params(url, page_id=None, page_size=1000):
+    '''
+    Build request parameters for a page of a paged wapi call
+
+    Parameters:
+        url (str): WAPI object URL including search arguments
+        page_id (str): next_page_id of the previous page, None for first
+        page_size (int): number of objects to retrieve per page
+    
+    Returns:
+        params (dict): parameters for request.get
+    '''
+    if page_id:
+        logging.debug(f'Next page: {page_id}')
+        params = { 'url': url.split('?')[0], 'params': { '_page_id': page_id } }
+    else:
+        params = { 'url': ( f'{url}&_paging=1&_return_as_object=1' +
+                            f'&_max_results={page_size}' ) }
+
+    return params
+
+
+def wapi_paged_call(session, url, page_size=1000):
     '''
-    Get the active leases for a network
+    Make paged wapi call, following next_page_id until all objects
+    have been retrieved
+
+    Parameters:
+        session (obj): Session object to use
+        url (str): WAPI object URL including search arguments
+        page_size (int): number of objects to retrieve per page
+    
+    Returns:
+        data: list of objects or None
+    '''
+    data = []
+    params = page_params(url, page_size=page_size)
+
+    while params:
+        page = wapi_call(session, **params)
+        if page is None:
+            logging.error('Failed to retrieve page of results')
+            data = None
+            break
+        data.extend(page.get('result', []))
+        page_id = page.get('next_page_id')
+        params = page_params(url, page_id) if page_id else None
+
+    return data
+
+
+def wapi_stream(session, url, page_size=1000):
+    '''
+    Make streamed, paged wapi call, parsing each page incrementally and
+    following next_page_id until all objects have been retrieved
+
+    Parameters:
+        session (obj): Session object to use
+        url (str): WAPI object URL including search arguments
+        page_size (int): number of objects to retrieve per page
+    
+    Yields:
+        Objects from the JSON response as they are parsed
+
+    Raises:
+        requests.HTTPError if a page cannot be retrieved
+    '''
+    params = page_params(url, page_size=page_size)
+
+    while params:
+        page_id = None
+        with session.get(stream=True, **params) as response:
+            if response.status_code not in STATUS_CODES_OK:
+                logging.debug(f'HTTP response: {response.status_code}')
+                logging.debug(f'Body: {response.content}')
+                logging.error('Failed to retrieve page of results')
+                raise requests.HTTPError(f'HTTP response: {response.status_code}',
+                                         response=response)
+
+            # Have urllib3 decompress the raw stream for ijson
+            response.raw.decode_content = True
+            builder = None
+            for prefix, event, value in ijson.parse(response.raw):
+                if prefix == 'next_page_id':
+                    page_id = value
+                elif prefix == 'result.item' and event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif builder is not None:
+                    builder.event(event, value)
+                    if prefix == 'result.item' and event == 'end_map':
+                        yield builder.value
+                        builder = None
+
+        params = page_params(url, page_id) if page_id else None
+
+    return
+
+
+def get_network_leases(config, ipaddr, net_view="default", active_only=False):
+    '''
+    Get the leases for a network
 
     Parameters:
         config (dict): config from inifile
         network (str): network address
         net_view (str): network view
+        active_only (bool): only return active leases
 
     Returns:
         List of leases objects
     '''
     lease_objects = []
-    base_url = f'https://{config.get("gm")}/wapi/{config.get("api_version")}'
+    gm = config['gm']
+    api_version = config['api_version']
+    base_url = f'https://{gm}/wapi/{api_version}'
     net_fields = '_return_fields=ip_address,network,network_view,status,types'
     lease_fields = ( '_return_fields=address,network,network_view,' +
                      'binding_state,hardware,cltt,ends,served_by,' +
                      'client_hostname' )
 
-    session = create_session(config)
+    session = get_session(config)
 
     # Get network with IPs
     url = ( f'{base_url}/ipv4address?ip_address={ipaddr}' +
@@ -237,7 +433,17 @@ def get_network_leases(config, ipaddr, net_view="default"):
     if network:
         logging.info(f'Retrieving leases')
         url = f'{base_url}/lease?network={network}&{lease_fields}'
-        lease_objects = wapi_call(session, url=url)
+        if active_only and ijson:
+            # Filter as each page is parsed, keeping only active leases
+            try:
+                lease_objects = process_network(wapi_stream(session, url))
+            except requests.HTTPError:
+                # Discard partial results, as wapi_paged_call() does
+                lease_objects = None
+        else:
+            lease_objects = wapi_paged_call(session, url)
+            if lease_objects and active_only:
+                lease_objects = process_network(lease_objects)
     else:
         lease_objects = []
     
@@ -249,18 +455,15 @@ def process_network(lease_objects):
     Generate the set of active leases
 
     Parameters:
-        lease_objects (list): list of dict of lease objects
+        lease_objects (iterable): list or generator of dict of lease objects
     
     Returns:
         List of active leases
 
     '''
-    active_leases = []
-
     logging.info('Processing leases for network')
-    for lease in lease_objects:
-        if lease.get('binding_state') == "ACTIVE":
-            active_leases.append(lease)
+    active_leases = [ lease for lease in lease_objects
+                      if lease.get('binding_state') == "ACTIVE" ]
 
     logging.debug(f'Active Leases: {active_leases}')
     
@@ -287,7 +490,6 @@ def main():
     exitcode = 0
     run_time = 0
     network_leases = []
-    active_leases = []
 
     # Parse CLI arguments
     args = parseargs()
@@ -299,23 +501,23 @@ def main():
     t1 = time.perf_counter()
     network_leases = get_network_leases(config, 
                                         args.ip4addr, 
-                                        net_view=args.view)
-
-    # Active Only
-    if network_leases and args.active_only:
-        active_leases = process_network(network_leases)
-        print(active_leases)
-
+                                        net_view=args.view,
+                                        active_only=args.active_only)
+    if not network_leases:
+        network_leases = []
     run_time = time.perf_counter() - t1
     
-    if active_leases:
-        print(active_leases)
-        print(f'{len(active_leases)} active leases retrieved')
+    # Rich is slow for large outputs, only use it to pretty print when debugging
+    if args.debug:
+        rprint(network_leases)
+    else:
+        print(json.dumps(network_leases, indent=2, default=str))
+    if args.active_only:
+        rprint(f'{len(network_leases)} active leases retrieved')
     else:
-        print(network_leases)
-        print(f'{len(network_leases)} leases retrieved')
+        rprint(f'{len(network_leases)} leases retrieved')
 
-    print('Run time: {}'.format(run_time))
+    rprint('Run time: {}'.format(run_time))
 
     return exitcode
 
@@ -4,8 +4,8 @@
 
  Description:
 
-    NIOS WAPI Benchmark Script
-    Uses threading with multiple sessions
+    Retrieve active leases for a network based on a network address
+    or CIDR, using paged bulk lease calls
 
  Requirements:
    Python 3.6+
@@ -49,12 +49,37 @@ __author_email__ = 'chris@infoblox.com'
 __license__ = 'BSD'
 
 import logging
-from rich import print
+import json
+from rich import print as rprint
 import requests
 import argparse
 import configparser
+import functools
+import os
 import time
-import concurrent.futures
+
+# Use the SIMD accelerated JSON parser if available, else orjson
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if simdjson:
+    _parser = simdjson.Parser()
+
+# HTTP status codes for a successful WAPI call
+STATUS_CODES_OK = frozenset(( 200, 201 ))
+
+# Keep-alive sessions keyed on the config they were built from
+_wapi_sessions = {}
+
+# Set once urllib3 certificate warnings have been disabled
+_warnings_disabled = False
 
 
 def parseargs():
@@ -75,10 +100,6 @@ def parseargs():
                         help="Specify network to get IP information")
     parse.add_argument('-v', '--view', type=str, default="default",
                         help="Specify the network view")
-    parse.add_argument('-t', '--threads', type=int, default=5,
-                        help="Number of Threads")
-    parse.add_argument('-s', '--sessions', type=int, default=1,
-                        help="Number of HTTP Session to create")
     parse.add_argument('-d', '--debug', action='store_true', 
                         help="Enable debug messages")
 
@@ -95,6 +116,28 @@ def read_ini(ini_filename):
     Returns:
         config :(dict): Dictionary of BloxOne configuration elements
 
+    '''
+    # Only re-parse the file if it has changed since it was last read
+    try:
+        mtime = os.path.getmtime(ini_filename)
+    except OSError:
+        mtime = None
+
+    return dict(_parse_ini(ini_filename, mtime))
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_ini(ini_filename, mtime):
+    '''
+    Parse ini file, cached on filename and modification time
+
+    Parameters:
+        ini_filename (str): name of inifile
+        mtime (float): modification time of inifile
+
+    Returns:
+        config :(dict): Dictionary of BloxOne configuration elements
+
     '''
     # Local Variables
     cfg = configparser.ConfigParser()
@@ -112,7 +155,7 @@ def read_ini(ini_filename):
         for key in ini_keys:
             # Check for key in BloxOne section
             if key in cfg['NIOS']:
-                config[key] = cfg['NIOS'][key].strip("'\"")
+                config[key] = _unquote(cfg['NIOS'][key])
                 logging.debug('Key {} found in {}: {}'.format(key, ini_filename, config[key]))
             else:
                 logging.warning('Key {} not found in NIOS section.'.format(key))
@@ -124,6 +167,22 @@ def read_ini(ini_filename):
     return config
 
 
+def _unquote(value):
+    '''
+    Remove matching quotes surrounding a value
+
+    Parameters:
+        value (str): value from inifile
+
+    Returns:
+        value without surrounding quotes
+    '''
+    if len(value) > 1 and value[0] in "'\"" and value[-1] == value[0]:
+        value = value[1:-1]
+
+    return value
+
+
 def setup_logging(debug):
     '''
      Set up logging
@@ -156,16 +215,21 @@ def create_session(config):
     Return:
         wapi_session (obj): request session object
     '''
-    headers = { 'content-type': "application/json" }
+    global _warnings_disabled
+
+    # Ask the GM to compress responses (gzip/deflate, br if brotli available)
+    headers = { 'content-type': "application/json",
+                'Accept-Encoding': requests.utils.DEFAULT_ACCEPT_ENCODING }
 
     if config['valid_cert'] == 'true':
         valid_cert = True
     else:
         valid_cert = False
 
-    # Avoid error due to a self-signed cert.
-    if not valid_cert:
+    # Avoid error due to a self-signed cert, only needed once per process
+    if not valid_cert and not _warnings_disabled:
         requests.packages.urllib3.disable_warnings()
+        _warnings_disabled = True
     
     wapi_session = requests.session()
     wapi_session.auth = (config['user'], config['pass'])
@@ -175,6 +239,24 @@ def create_session(config):
     return wapi_session
 
 
+def get_session(config):
+    '''
+    Get the WAPI session for a GM config, creating it on first use
+
+    Parameters:
+        config (dict): GM config
+    
+    Return:
+        wapi_session (obj): request session object
+    '''
+    key = tuple(sorted(config.items()))
+
+    if key not in _wapi_sessions:
+        _wapi_sessions[key] = create_session(config)
+
+    return _wapi_sessions[key]
+
+
 def wapi_call(session, **params):
     '''
     Make wapi call
@@ -186,11 +268,14 @@ def wapi_call(session, **params):
 i   Returns:
         data: JSON response as object (list/dict) or None
     '''
-    status_codes_ok = [ 200, 201 ]
-
     response = session.get(**params)
-    if response.status_code in [ 200, 201 ]:
-        data = response.json()
+    if response.status_code in STATUS_CODES_OK:
+        if simdjson:
+            data = _parser.parse(response.content, recursive=True)
+        elif orjson:
+            data = orjson.loads(response.content)
+        else:
+            data = response.json()
     else:
         logging.debug(f'HTTP response: {response.status_code}')
         logging.debug(f'Body: {response.content}')
@@ -199,117 +284,126 @@ i   Returns:
     return data
 
 
-def make_wapi_calls(sessions, url):
+def page_params(url, page_id=None, page_size=1000):
     '''
+    Build request parameters for a page of a paged wapi call
+
+    Parameters:
+        url (str): WAPI object URL including search arguments
+        page_id (str): next_page_id of the previous page, None for first
+        page_size (int): number of objects to retrieve per page
+    
+    Returns:
+        params (dict): parameters for request.get
     '''
-    results = {}
+    if page_id:
+        logging.debug(f'Next page: {page_id}')
+        params = { 'url': url.split('?')[0], 'params': { '_page_id': page_id } }
+    else:
+        params = { 'url': ( f'{url}&_paging=1&_return_as_object=1' +
+                            f'&_max_results={page_size}' ) }
 
-    for z in range(0, (len(sessions)-1)):
-        results.append(wapi_call(sessions[z], url=url))
+    return params
 
-    return results
 
+def wapi_paged_call(session, url, page_size=1000):
+    '''
+    Make paged wapi call, following next_page_id until all objects
+    have been retrieved
 
-def get_network_leases(config, 
-                       network, 
-                       net_view="default", 
-                       threads=5, 
-                       no_of_sessions=1):
+    Parameters:
+        session (obj): Session object to use
+        url (str): WAPI object URL including search arguments
+        page_size (int): number of objects to retrieve per page
+    
+    Returns:
+        data: list of objects or None
+    '''
+    data = []
+    params = page_params(url, page_size=page_size)
+
+    while params:
+        page = wapi_call(session, **params)
+        if page is None:
+            logging.error('Failed to retrieve page of results')
+            data = None
+            break
+        data.extend(page.get('result', []))
+        page_id = page.get('next_page_id')
+        params = page_params(url, page_id) if page_id else None
+
+    return data
+
+
+def get_network_leases(config, network, net_view="default"):
     '''
     Get the active leases for a network
 
     Parameters:
         config (dict): config from inifile
-        network (str): network address
+        network (str): network address or CIDR
         net_view (str): network view
-        threads (int): number of threads to execute
-        no_of_sessions (int): number of http sessions used by threads
 
     Returns:
-        runt_time (time): execution time
+        List of active lease objects
     '''
-    run_time = 0
-    results = []
     lease_objects = []
-    sessions = []
-    tasks = []
-    base_url = f'https://{config.get("gm")}/wapi/{config.get("api_version")}'
-    lease_fields = ( '_return_fields=address,binding_state,hardware,' +
-                     'cltt,ends,served_by,client_hostname' )
-
-    # Create one or more HTTP sessions, this may improve performance
-    if no_of_sessions > 10:
-        # Reset to max recommended
-        no_of_sessions = 10
-
-    for i in range(0, (no_of_sessions)):
-        sessions.append(create_session(config))
-
-    # Get network with IPs
-    url = f'{base_url}/ipv4address?network={network}&network_view={net_view}'
-    # Use base session
-    logging.info(f'Retrieving network: {network}')
-    net_data = wapi_call(sessions[0], url=url)
-    if net_data:
-        logging.info('Network retrieved successfully')
-        lease_objects = process_network(net_data)
-    else:
-        logging.error('Failed to retrieve network')
-        lease_objects = []
-    
-    # Get lease objects
-    logging.info(f'Retrieving {len(lease_objects)} leases')
-    if lease_objects:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            index = 0
-            max_index = len(lease_objects) - 1
-            while index <= max_index:
-                for i in range(0, (no_of_sessions)):
-                    url = f'{base_url}/{lease_objects[index]}?{lease_fields}'
-                    logging.debug(f'Lease URL: {url}')
-                    tasks.append(executor.submit(wapi_call, 
-                                                 session=sessions[i], 
-                                                 url=url))
-                    index += 1
-                    if index > max_index:
-                        break
+    gm = config['gm']
+    api_version = config['api_version']
+    base_url = f'https://{gm}/wapi/{api_version}'
+    net_fields = '_return_fields=network'
+    lease_fields = ( '_return_fields=address,network,network_view,' +
+                     'binding_state,hardware,cltt,ends,served_by,' +
+                     'client_hostname' )
+
+    session = get_session(config)
+
+    # Resolve the network CIDR from the network address
+    if '/' not in network:
+        url = ( f'{base_url}/ipv4address?ip_address={network}' +
+                f'&network_view={net_view}&{net_fields}&_max_results=1' )
+        logging.info(f'Retrieving network: {network}')
+        net_data = wapi_call(session, url=url)
+        if net_data:
+            logging.info('Network retrieved successfully')
+            network = net_data[0].get('network')
+            logging.debug(f'Network: {network}')
+        else:
+            logging.error('Failed to retrieve network')
+            network = None
     
-        # results = process_tasks(tasks)
-        for task in concurrent.futures.as_completed(tasks):
-            results.append(task.result())
-    else:
-        results = []
+    # Get all lease objects for the network, a page at a time
+    if network:
+        logging.info(f'Retrieving leases for {network}')
+        url = f'{base_url}/lease?network={network}&{lease_fields}'
+        lease_objects = wapi_paged_call(session, url)
+        if lease_objects:
+            lease_objects = process_network(lease_objects)
+        else:
+            lease_objects = []
     
-    return results
+    return lease_objects
 
 
-def process_network(net_data):
+def process_network(lease_objects):
     '''
-    Generate the set of lease objects from the network
+    Generate the set of active leases
 
     Parameters:
-        net_data (dict): Dict from json data
+        lease_objects (list): list of dict of lease objects
     
     Returns:
+        List of active leases
 
     '''
-    lease_objects = []
+    logging.info('Processing leases for network')
+    active_leases = [ lease for lease in lease_objects
+                      if lease.get('binding_state') == "ACTIVE" ]
 
-    logging.info('Processing network')
-    for element in net_data:
-        if element.get('status') == "USED":
-            if element.get('usage'):
-                if "DHCP" in element.get('usage'):
-                    # Gather lease objects
-                    if element.get('objects'):
-                        for obj in element.get('objects'):
-                            if 'lease' in obj:
-                                logging.debug(f'Lease object found for: element.get("ip_address")')
-                                lease_objects.append(obj)
-                                break
-    logging.debug(f'Lease Objects: {lease_objects}§')
+    logging.debug(f'Active Leases: {active_leases}')
     
-    return lease_objects
+    return active_leases
+
 
 '''
     url = mainurl+"lease?address="+ip+"&_return_fields=binding_state,hardware,client_hostname,starts,ends&_max_results=1&_return_as_object=1"
@@ -342,13 +436,16 @@ def main():
     t1 = time.perf_counter()
     network_leases = get_network_leases(config, 
                                         args.network, 
-                                        net_view=args.view,
-                                        threads=args.threads)
+                                        net_view=args.view)
     run_time = time.perf_counter() - t1
     
-    print(network_leases)
-    print(f'{len(network_leases)} leases retrieved')
-    print('Run time: {}'.format(run_time))
+    # Rich is slow for large outputs, only use it to pretty print when debugging
+    if args.debug:
+        rprint(network_leases)
+    else:
+        print(json.dumps(network_leases, indent=2, default=str))
+    rprint(f'{len(network_leases)} leases retrieved')
+    rprint('Run time: {}'.format(run_time))
 
     return exitcode
 